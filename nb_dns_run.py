@@ -4,7 +4,7 @@
 # Edit to suit.
 
 import dns.tsig, dns.tsigkeyring
-from nb_dns_updater import DummyUpdater, DDNSUpdater, simple_server
+from nb_dns_updater import DummyUpdater, DDNSUpdater, make_app, serve
 
 SERVER = '127.0.0.1'
 KEY_ID = 'my-key-name'
@@ -27,5 +27,8 @@ ZONES = {
     "8.b.d.0.1.0.0.2.ip6.arpa": ddns,
 }
 
+# WSGI application, e.g. for "gunicorn -k gthread --threads 16 nb_dns_run:app"
+app = make_app(ZONES, api_key=WEBHOOK_SECRET)
+
 if __name__ == "__main__":
-    simple_server(ZONES, api_key=WEBHOOK_SECRET)
+    serve(app)
@@ -3,19 +3,57 @@ This is a dynamic DNS webhook for Netbox.  It updates A/AAAA and PTR records
 based on the dns_name attribute of ipam.ipaddress records.
 """
 
+import concurrent.futures
+import dns.exception
+import dns.flags
 import dns.name
 import dns.update
 import dns.query
 import dns.rcode
 import dns.reversename
+import functools
 import hashlib
 import hmac
+import ipaddress
 import json
 import socket
 import sys
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 IP6_ARPA = dns.name.from_text("ip6.arpa")
 
+# dns.name.Name is immutable, so parsed names can be shared between requests
+_name_from_text = functools.lru_cache(maxsize=4096)(dns.name.from_text)
+_rev_from_address = functools.lru_cache(maxsize=4096)(dns.reversename.from_address)
+
+def _lower_labels(dnsname):
+    """Lowercased label tuple, the same as canonicalize() but without building a Name"""
+    return tuple(label.lower() for label in dnsname.labels)
+
+if orjson:
+    # orjson parses bytes directly, without a separate decode step
+    _json_loads = orjson.loads
+else:
+    def _json_loads(data):
+        return json.loads(data.decode('UTF-8'))
+
+@functools.lru_cache(maxsize=4096)
+def _relative_text(labels, zone_depth):
+    """
+    Text of a name relative to an enclosing zone with zone_depth labels.
+    Keyed on the raw labels rather than dns.name.Name, which compares
+    case-insensitively, so the original case is preserved.
+    """
+    rel_labels = labels[:-zone_depth]
+    if not rel_labels:
+        return "@"
+    return dns.name.Name(rel_labels).to_text()
+
 class DummyUpdater:
     """
     Just print the updates which would be done, without doing anything
@@ -25,34 +63,133 @@ class DummyUpdater:
 
     def __call__(self, zone, updates):
         if self.debug:
-            self.debug("Zone %s" % zone)
-            for u in updates:
-                self.debug(u)
+            self.debug("Zone %s\n%s" % (zone, "\n".join(repr(u) for u in updates)))
 
 class DDNSUpdater:
     """
     A callable which performs a batch of DDNS updates,
     supplied as a list of tuples of (action_name, dns_name, args...)
+
+    If use_udp is set, updates are sent over UDP first, falling back to TCP
+    if the response is truncated or does not arrive within udp_timeout.
+
+    TCP connections are kept open for reuse, up to max_idle of them.  Each
+    TCP exchange must complete within tcp_timeout seconds.
     """
-    def __init__(self, server, debug=lambda x: print(x, file=sys.stderr), **kwargs):
-        # we can accept either an IP address or a hostname
-        self.server = socket.getaddrinfo(server, None)[0][4][0]
+    def __init__(self, server, debug=lambda x: print(x, file=sys.stderr),
+                 use_udp=False, udp_timeout=5, tcp_timeout=10, max_idle=4, **kwargs):
         self.debug = debug
+        self.use_udp = use_udp
+        self.udp_timeout = udp_timeout
+        self.tcp_timeout = tcp_timeout
+        self.max_idle = max_idle
         self.kwargs = kwargs
+        # Idle TCP connections to the server, kept open for reuse, as
+        # (socket, generation) pairs.  There may be more than one when
+        # updates to several zones run in parallel.  The generation is bumped
+        # by resolve_server, so that connections to an old address are not
+        # put back in the pool.
+        self._socks = []
+        self._generation = 0
+        self._lock = threading.Lock()
+        # we can accept either an IP address or a hostname
+        self.server_name = server
+        self.resolve_server()
+
+    def resolve_server(self):
+        """
+        Set self.server and self.server_af from the configured server.  This is
+        done at startup; if the server was given as a hostname, call it again
+        to pick up a change of address.
+        """
+        try:
+            addr = ipaddress.ip_address(self.server_name)
+        except ValueError:
+            family, _, _, _, sockaddr = socket.getaddrinfo(
+                self.server_name, 53, proto=socket.IPPROTO_TCP)[0]
+            server = sockaddr[0]
+        else:
+            family = socket.AF_INET6 if addr.version == 6 else socket.AF_INET
+            server = str(addr)
+        with self._lock:
+            self.server_af = family
+            self.server = server
+            self._generation += 1
+            socks, self._socks = self._socks, []
+        # Drop any idle connections to the old address; ones in use are
+        # closed by _send when they are finished with
+        for sock, _ in socks:
+            sock.close()
+
+    def _connect(self):
+        """Open a new connection, returning (socket, generation)"""
+        with self._lock:
+            family, server, generation = self.server_af, self.server, self._generation
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.tcp_timeout)
+        try:
+            sock.connect((server, 53))
+        except OSError:
+            sock.close()
+            raise
+        # dns.query.tcp requires a non-blocking connected socket
+        sock.setblocking(False)
+        return sock, generation
+
+    def _send(self, updater):
+        """
+        Send an update over an idle connection if there is one, otherwise
+        open a new one.  If a reused connection has been closed by the server,
+        or silently dropped (e.g. by a firewall) so that the reply times out,
+        retry once on a fresh connection.
+        """
+        with self._lock:
+            sock, generation = self._socks.pop() if self._socks else (None, None)
+        retry = sock is not None
+        if sock is None:
+            sock, generation = self._connect()
+        while True:
+            try:
+                response = dns.query.tcp(updater, self.server,
+                                         timeout=self.tcp_timeout, sock=sock)
+                break
+            except (EOFError, OSError, dns.exception.Timeout):
+                sock.close()
+                if not retry:
+                    raise
+                retry = False
+                sock, generation = self._connect()
+            except Exception:
+                sock.close()
+                raise
+        with self._lock:
+            if generation == self._generation and len(self._socks) < self.max_idle:
+                self._socks.append((sock, generation))
+                sock = None
+        if sock is not None:
+            sock.close()
+        return response
 
     def __call__(self, zone, updates):
         """
         Takes a list of updates and sends a DDNS update request
         """
         if self.debug:
-            self.debug("Zone %s" % zone)
-            for u in updates:
-                self.debug(u)
+            self.debug("Zone %s\n%s" % (zone, "\n".join(repr(u) for u in updates)))
 
         updater = dns.update.Update(zone, **self.kwargs)
         for (action, args) in updates:
             getattr(updater, action)(*args)
-        response = dns.query.tcp(updater, self.server)
+        response = None
+        if self.use_udp:
+            try:
+                response = dns.query.udp(updater, self.server, timeout=self.udp_timeout)
+                if response.flags & dns.flags.TC:
+                    response = None
+            except dns.exception.Timeout:
+                pass
+        if response is None:
+            response = self._send(updater)
         rcode = response.rcode()
         if rcode != dns.rcode.NOERROR:
             return "DNS update for %s failed: %s" % (zone, dns.rcode.to_text(rcode))
@@ -63,22 +200,32 @@ class UpdateMapper:
     a particular record, it identifies the correct zone and appends to a list of
     updates.  At commit time, the list of updates is passed to the relevant updater.
     """
-    def __init__(self, zones):
-        self.zones = { dns.name.from_text(n): v for n, v in zones.items() }
+    def __init__(self, zones, debug=lambda x: print(x, file=sys.stderr), max_workers=4):
+        self.zones = { _name_from_text(n): v for n, v in zones.items() }
+        # Index zones by their (lowercased) labels for suffix matching in _find
+        self._zone_labels = { _lower_labels(n): (n, v) for n, v in self.zones.items() }
+        self._max_depth = max((len(k) for k in self._zone_labels), default=0)
+        self.debug = debug
+        # Updates to different zones (e.g. forward and reverse) are independent
+        # and can be sent concurrently.  The pool is shared by all requests, so
+        # commit() only uses it for zones beyond the first.
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
 
     def begin(self):
-        """Return a mapping of dns.name to updates"""
+        """Return a mapping of dns.name to (updater, updates)"""
         return {}
 
     def _find(self, dnsname):
-        """Map a name to its enclosing zone"""
-        while True:
-            if dnsname in self.zones:
-                return dnsname
-            try:
-                dnsname = dnsname.parent()
-            except dns.name.NoParent:
-                return None
+        """
+        Map a name to its enclosing zone, i.e. the longest matching suffix.
+        Returns a tuple of (zonename, updater), or None if there is no zone.
+        """
+        labs = _lower_labels(dnsname)
+        for i in range(max(0, len(labs) - self._max_depth), len(labs)):
+            z = self._zone_labels.get(labs[i:])
+            if z is not None:
+                return z
+        return None
 
     def _record(self, ctx, action, dnsname, *args):
         """
@@ -87,12 +234,13 @@ class UpdateMapper:
 
         self._record(ctx, "replace", dns.name.from_text("foo.example.com"), 300, "a", "192.0.2.1")
         """
-        zonename = self._find(dnsname)
-        if zonename is None:
+        zone = self._find(dnsname)
+        if zone is None:
             return
-        if zonename not in ctx:
-            ctx[zonename] = []
-        ctx[zonename].append((action, (dnsname.relativize(zonename).to_text(), *args)))
+        zonename, updater = zone
+        # Keyed on the zone name, as the updater need not be hashable
+        ctx.setdefault(zonename, (updater, []))[1].append(
+            (action, (_relative_text(dnsname.labels, len(zonename.labels)), *args)))
 
     def add(self, ctx, dnsname, ttl, rrtype, data):
         self._record(ctx, "add", dnsname, ttl, rrtype, data)
@@ -105,8 +253,12 @@ class UpdateMapper:
 
     def commit(self, ctx):
         errors = []
-        for n, updates in ctx.items():
-            err = self.zones[n](n, updates)
+        if not ctx:
+            return errors
+        (n, (updater, updates)), *rest = ctx.items()
+        futures = [self.pool.submit(u, z, ups) for z, (u, ups) in rest]
+        results = [updater(n, updates)] + [f.result() for f in futures]
+        for err in results:
             if err:
                 if self.debug:
                     self.debug(err)
@@ -119,10 +271,18 @@ class DNSWebHook:
     and apply dynamic DNS updates.  It extracts the address and dns_name
     from the "prechange" and "postchange" snapshots.
     """
-    def __init__(self, mapper, api_key=None, ttl=3600):
+    def __init__(self, mapper, api_key=None, ttl=3600, digestmod=hashlib.sha512,
+                 max_body_size=1024*1024):
         self.mapper = mapper
         self.api_key = api_key.encode('utf8') if isinstance(api_key, str) else api_key
         self.ttl = ttl
+        self.max_body_size = max_body_size
+        # Must match the digest used by the sender: Netbox signs with SHA-512
+        self.digestmod = digestmod
+        # Key the HMAC once; each request works on a copy of this
+        self._hmac_template = None
+        if self.api_key:
+            self._hmac_template = hmac.new(self.api_key, digestmod=self.digestmod)
 
     def __call__(self, environ, start_response):
         headers = [('Content-type', 'text/plain')]
@@ -131,24 +291,38 @@ class DNSWebHook:
             start_response(status, headers)
             return [b'Method not allowed']
 
+        # If Netbox is configured to send the model in a header, we can reject
+        # other models without reading the body or checking the signature
+        model = environ.get('HTTP_X_HOOK_MODEL')
+        if model is not None and model != 'ipaddress':
+            status = '400 Wrong model'
+            start_response(status, headers)
+            return [b'Wrong model']
+
         try:
             request_body_size = int(environ.get('CONTENT_LENGTH', 0))
         except (ValueError):
             request_body_size = 0
+        if request_body_size < 0:
+            request_body_size = 0
+        if request_body_size > self.max_body_size:
+            status = '413 Request entity too large'
+            start_response(status, headers)
+            return [b'Request entity too large']
         request_body = environ['wsgi.input'].read(request_body_size)
 
-        if self.api_key:
-            hmac_prep = hmac.new(
-                key=self.api_key,
-                msg=request_body,
-                digestmod=hashlib.sha512
-            )
-            if environ.get('HTTP_X_HOOK_SIGNATURE') != hmac_prep.hexdigest():
+        if self._hmac_template is not None:
+            h = self._hmac_template.copy()
+            h.update(request_body)
+            expected = h.hexdigest().encode('ascii')
+            # WSGI header values are latin-1 decoded str
+            sig = (environ.get('HTTP_X_HOOK_SIGNATURE') or '').encode('latin-1')
+            if not hmac.compare_digest(sig, expected):
                 status = '403 Forbidden'
                 start_response(status, headers)
                 return [b'X-Hook-Signature missing or invalid']
 
-        body = json.loads(request_body.decode('UTF-8'))
+        body = _json_loads(request_body)
         if body["model"] != "ipaddress":
             status = '400 Wrong model'
             start_response(status, headers)
@@ -191,31 +365,45 @@ class DNSWebHook:
         ctx = self.mapper.begin()
 
         if oldaddress and oldname:
-            revname = dns.reversename.from_address(oldaddress)
+            revname = _rev_from_address(oldaddress)
             rrtype = "AAAA" if revname.is_subdomain(IP6_ARPA) else "A"
-            rrname = dns.name.from_text(oldname)
+            rrname = _name_from_text(oldname)
             self.mapper.delete(ctx, rrname, rrtype, oldaddress)
             self.mapper.delete(ctx, revname, "PTR", rrname.to_text())
 
         if newaddress and newname:
-            revname = dns.reversename.from_address(newaddress)
+            revname = _rev_from_address(newaddress)
             rrtype = "AAAA" if revname.is_subdomain(IP6_ARPA) else "A"
-            rrname = dns.name.from_text(newname)
+            rrname = _name_from_text(newname)
             self.mapper.add(ctx, rrname, self.ttl, rrtype, newaddress)
             self.mapper.add(ctx, revname, self.ttl, "PTR", rrname.to_text())
 
         return self.mapper.commit(ctx)
 
-def simple_server(zones, host='', port=7001, **kwargs):
-    from wsgiref.simple_server import make_server
+def make_app(zones, max_workers=4, **kwargs):
+    """
+    Build the WSGI application.  This can be served by serve(), or by
+    any WSGI container such as gunicorn or waitress.
+    """
+    mapper = UpdateMapper(zones, max_workers=max_workers)
+    return DNSWebHook(mapper, **kwargs)
+
+def serve(app, host='', port=7001):
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import make_server, WSGIServer
     # TODO: SSL
     # Note: does not support IPv6. See
     # https://github.com/bottlepy/bottle/issues/525
-    mapper = UpdateMapper(zones)
-    app = DNSWebHook(mapper, **kwargs)
-    httpd = make_server(host, port, app)
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        # Handle each webhook in its own thread, so that one slow DNS update
+        # doesn't hold up the others
+        daemon_threads = True
+    httpd = make_server(host, port, app, server_class=ThreadingWSGIServer)
     httpd.serve_forever()
 
+def simple_server(zones, host='', port=7001, **kwargs):
+    serve(make_app(zones, **kwargs), host=host, port=port)
+
 if __name__ == "__main__":
     # Quick hack for testing from CLI: pass old address, old name,
     # new address and new name, and it shows the updates it would make